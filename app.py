@@ -1,33 +1,164 @@
-from fastapi import FastAPI, Request, Form, HTTPException, Query, Response
+from fastapi import FastAPI, Request, Form, HTTPException, Query, Response, Depends
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from jinja2 import FileSystemBytecodeCache
+import asyncio
 import database
-import json
+import orjson
 import os
-from typing import Optional, List
-from datetime import datetime
-import uuid
-
-app = FastAPI(title="Планировщик севооборота")
+import hashlib
+from typing import Annotated, Optional, List, Tuple
+from datetime import datetime, timedelta
+import secrets
+from urllib.parse import urlsplit
+from bisect import bisect_right
+from types import MappingProxyType
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, Json, StringConstraints, ValidationError, field_validator
+
+app = FastAPI(title="Планировщик севооборота", default_response_class=ORJSONResponse)
 
 # Настройка шаблонов и статических файлов
 current_dir = os.path.dirname(os.path.abspath(__file__))
-templates = Jinja2Templates(directory=os.path.join(current_dir, "templates"))
-app.mount("/static", StaticFiles(directory=os.path.join(current_dir, "static")), name="static")
+# Шаблоны не перечитываются с диска на каждый запрос: без auto_reload Jinja
+# не делает stat() файлов, а неограниченный кэш хранит все скомпилированные шаблоны.
+# Байткод шаблонов сохраняется во временный каталог и переживает перезапуск
+templates = Jinja2Templates(
+    directory=os.path.join(current_dir, "templates"),
+    auto_reload=False,
+    cache_size=-1,
+    bytecode_cache=FileSystemBytecodeCache()
+)
+# Фильтр |tojson сериализует данные для карт и графиков через orjson
+templates.env.policies["json.dumps_function"] = lambda obj, **kwargs: orjson.dumps(obj).decode()
+
+
+class CachedStaticFiles(StaticFiles):
+    """Статические файлы с Cache-Control: браузер не перезапрашивает их в течение суток"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
+
+
+app.mount("/static", CachedStaticFiles(directory=os.path.join(current_dir, "static")), name="static")
+
+
+# Шаблоны загружаются один раз при старте, обработчики рендерят их напрямую
+INDEX_TEMPLATE = templates.get_template("index.html")
+FIELDS_TEMPLATE = templates.get_template("fields.html")
+FIELD_DETAIL_TEMPLATE = templates.get_template("field_detail.html")
+HISTORY_TEMPLATE = templates.get_template("history.html")
+ADD_HISTORY_MAP_TEMPLATE = templates.get_template("add_history_map.html")
+EDIT_HISTORY_TEMPLATE = templates.get_template("edit_history.html")
+RECOMMENDATIONS_TEMPLATE = templates.get_template("recommendations.html")
+CALCULATOR_TEMPLATE = templates.get_template("calculator.html")
+
+
+def render_template(template, context):
+    return HTMLResponse(template.render(context))
+
+
+# Базовые правила для культур
+CROP_RULES = (
+    {"crop": "пшеница", "family": "Злаковые"},
+    {"crop": "картофель", "family": "Пасленовые"},
+    {"crop": "подсолнечник", "family": "Астровые"},
+    {"crop": "горох", "family": "Бобовые"},
+    {"crop": "ячмень", "family": "Злаковые"},
+    {"crop": "кукуруза", "family": "Злаковые"},
+    {"crop": "овёс", "family": "Злаковые"},
+    {"crop": "соя", "family": "Бобовые"},
+    {"crop": "рожь", "family": "Злаковые"},
+    {"crop": "гречиха", "family": "Гречишные"},
+    {"crop": "лён", "family": "Льновые"}
+)
+
+# Рекомендации по типу почвы
+SOIL_RECOMMENDATIONS = MappingProxyType({
+    'суглинок': 'Хорошо подходит для большинства культур',
+    'чернозем': 'Отличная почва для всех культур',
+    'песчаная': 'Требует больше полива и удобрений',
+    'глинистая': 'Нуждается в улучшении дренажа',
+    'торфяная': 'Требует известкования'
+})
+
+# Затраты и доход на гектар для калькулятора
+CROP_PRICES = MappingProxyType({
+    "пшеница": {"cost_per_ha": 15000, "income_per_ha": 30000},
+    "картофель": {"cost_per_ha": 50000, "income_per_ha": 80000},
+    "подсолнечник": {"cost_per_ha": 25000, "income_per_ha": 45000},
+    "горох": {"cost_per_ha": 18000, "income_per_ha": 35000},
+    "ячмень": {"cost_per_ha": 14000, "income_per_ha": 28000},
+    "кукуруза": {"cost_per_ha": 30000, "income_per_ha": 60000},
+    "овёс": {"cost_per_ha": 13000, "income_per_ha": 25000},
+    "соя": {"cost_per_ha": 22000, "income_per_ha": 45000},
+    "рожь": {"cost_per_ha": 12000, "income_per_ha": 24000},
+    "гречиха": {"cost_per_ha": 16000, "income_per_ha": 32000},
+    "лён": {"cost_per_ha": 20000, "income_per_ha": 40000}
+})
+DEFAULT_CROP_PRICE = MappingProxyType({"cost_per_ha": 20000, "income_per_ha": 40000})
+
+
+_SPRING_ADVICE = "Оптимальное время для весенней посадки"
+_SUMMER_ADVICE = "Рассмотрите возможность летнего посева или подготовки к осени"
+_AUTUMN_ADVICE = "Подходящее время для осенней посадки озимых культур"
+
+# Сезонные рекомендации по номеру месяца (индекс 0 не используется)
+SEASON_ADVICE = (
+    "",
+    _AUTUMN_ADVICE, _AUTUMN_ADVICE,
+    _SPRING_ADVICE, _SPRING_ADVICE, _SPRING_ADVICE,
+    _SUMMER_ADVICE, _SUMMER_ADVICE, _SUMMER_ADVICE,
+    _AUTUMN_ADVICE, _AUTUMN_ADVICE, _AUTUMN_ADVICE, _AUTUMN_ADVICE
+)
+
+# Рекомендации по площади поля: до 5 га, до 20 га и больше
+AREA_ADVICE_BOUNDS = (5, 20)
+AREA_ADVICE = (
+    "Малая площадь - рассмотрите интенсивные технологии",
+    "Средняя площадь - подходят стандартные технологии",
+    "Большая площадь - эффективны механизированные технологии"
+)
+
+# Готовые GeoJSON-ответы по id поля: (тело ответа, ETag)
+GEOJSON_CACHE = TTLCache(maxsize=1024, ttl=300)
+
+# Готовый ответ /api/fields/overview: (тело ответа, ETag).
+# Кэш свой у каждого процесса и сбрасывается только в том, где поле создали или удалили:
+# при нескольких воркерах остальные отдают прежний список до OVERVIEW_CACHE_TTL секунд
+# (плюс QUERY_CACHE_TTL кэша выборок в database.py)
+OVERVIEW_CACHE_TTL = 60
+OVERVIEW_CACHE = TTLCache(maxsize=1, ttl=OVERVIEW_CACHE_TTL)
+
+# Время жизни сессии совпадает со сроком жизни cookie
+SESSION_LIFETIME = timedelta(hours=24)
+MAX_SESSIONS = 100000
+# Как часто (в секундах) из памяти вычищаются просроченные сессии
+SESSION_CLEANUP_INTERVAL = 300
+# Как часто (в секундах) пересобирается статистика планировщика запросов SQLite
+DB_STATISTICS_INTERVAL = 3600
+
+# Не больше WRITE_RATE_LIMIT запросов на изменение данных за WRITE_RATE_WINDOW секунд от одной сессии
+WRITE_RATE_LIMIT = 30
+WRITE_RATE_WINDOW = 60
 
 
 # Простой менеджер сессий в памяти
 class SessionManager:
     def __init__(self):
-        self.sessions = {}
+        # Ограниченный кэш: просроченные и самые старые сессии вытесняются автоматически
+        self.sessions = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_LIFETIME.total_seconds())
 
     def create_session(self):
-        session_id = str(uuid.uuid4())
+        # 128 бит случайности, как у uuid4, но короче и быстрее
+        session_id = secrets.token_urlsafe(16)
         self.sessions[session_id] = {
             'flash_message': None,
-            'flash_error': None,
-            'created_at': datetime.now()
+            'flash_error': None
         }
         return session_id
 
@@ -35,56 +166,109 @@ class SessionManager:
         return self.sessions.get(session_id)
 
     def set_flash_message(self, session_id, message):
-        if session_id in self.sessions:
-            self.sessions[session_id]['flash_message'] = message
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session['flash_message'] = message
 
     def set_flash_error(self, session_id, message):
-        if session_id in self.sessions:
-            self.sessions[session_id]['flash_error'] = message
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session['flash_error'] = message
 
-    def pop_flash_message(self, session_id):
-        if session_id in self.sessions:
-            message = self.sessions[session_id]['flash_message']
-            self.sessions[session_id]['flash_message'] = None
-            return message
-        return None
+    def pop_flash_messages(self, session_id):
+        """Забирает и очищает сообщение и ошибку за одно обращение к сессии"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None, None
+        message, error = session['flash_message'], session['flash_error']
+        session['flash_message'] = session['flash_error'] = None
+        return message, error
 
-    def pop_flash_error(self, session_id):
-        if session_id in self.sessions:
-            message = self.sessions[session_id]['flash_error']
-            self.sessions[session_id]['flash_error'] = None
-            return message
-        return None
+    def cleanup_old_sessions(self):
+        """Удаляет просроченные сессии, к которым больше никто не обращается"""
+        self.sessions.expire()
 
 
 session_manager = SessionManager()
 
 
+async def periodic_session_cleanup():
+    while True:
+        await asyncio.sleep(SESSION_CLEANUP_INTERVAL)
+        session_manager.cleanup_old_sessions()
+
+
+@app.on_event("startup")
+async def start_session_cleanup():
+    app.state.session_cleanup_task = asyncio.create_task(periodic_session_cleanup())
+
+
+@app.on_event("shutdown")
+async def stop_session_cleanup():
+    app.state.session_cleanup_task.cancel()
+
+
+@app.on_event("startup")
+async def open_database():
+    # База открывается (и при необходимости обновляется схема) до первого запроса и вне цикла событий
+    await run_in_threadpool(database.get_db)
+
+
+async def periodic_statistics_refresh():
+    # Первый пересбор сразу после старта: база могла прийти со статистикой, собранной на малом объеме данных
+    while True:
+        await run_in_threadpool(database.get_db().refresh_statistics)
+        await asyncio.sleep(DB_STATISTICS_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_statistics_refresh():
+    app.state.statistics_refresh_task = asyncio.create_task(periodic_statistics_refresh())
+
+
+@app.on_event("shutdown")
+async def stop_statistics_refresh():
+    app.state.statistics_refresh_task.cancel()
+
+
+@app.on_event("shutdown")
+def close_database():
+    database.get_db().close()
+
+
 # Middleware для обработки сессий
 @app.middleware("http")
 async def session_middleware(request: Request, call_next):
+    # Статическим файлам сессия не нужна
+    if request.url.path.startswith("/static/"):
+        return await call_next(request)
+
     session_id = request.cookies.get("session_id")
+    created = False
 
     if not session_id or not session_manager.get_session(session_id):
         session_id = session_manager.create_session()
+        created = True
 
     request.state.session_id = session_id
     response = await call_next(request)
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        max_age=3600 * 24,
-        httponly=True,
-        samesite="lax"
-    )
+    # Cookie отправляется только для новой сессии, у клиента она уже есть
+    if created:
+        response.set_cookie(
+            key="session_id",
+            value=session_id,
+            max_age=int(SESSION_LIFETIME.total_seconds()),
+            httponly=True,
+            samesite="lax"
+        )
     return response
 
 
 def get_flash_messages(request: Request):
-    session_id = request.state.session_id
+    message, error = session_manager.pop_flash_messages(request.state.session_id)
     return {
-        'flash_message': session_manager.pop_flash_message(session_id),
-        'flash_error': session_manager.pop_flash_error(session_id)
+        'flash_message': message,
+        'flash_error': error
     }
 
 
@@ -98,20 +282,61 @@ def set_flash_error(request: Request, message: str):
     session_manager.set_flash_error(session_id, message)
 
 
+# Счетчики запросов по сессии (или адресу клиента), запись живет одно окно WRITE_RATE_WINDOW
+write_counters = TTLCache(maxsize=MAX_SESSIONS, ttl=WRITE_RATE_WINDOW)
+
+
+class WriteRateLimitExceeded(Exception):
+    """Лимит запросов на изменение данных исчерпан"""
+
+
+def write_rate_key(request: Request):
+    """Ключ счетчика: сессия из cookie, а без нее адрес клиента.
+
+    Сессия, созданная для этого же запроса, не годится: клиент без cookie получал бы новый счетчик каждый раз
+    """
+    if request.cookies.get("session_id") == request.state.session_id:
+        return request.state.session_id
+    return request.client.host if request.client else ""
+
+
+async def limit_write_rate(request: Request):
+    """Отклоняет запросы на запись сверх лимита, не доходя до базы данных"""
+    key = write_rate_key(request)
+    counter = write_counters.get(key)
+    if counter is None:
+        write_counters[key] = [1]
+        return
+    # Счетчик меняется на месте, чтобы не продлевать срок жизни записи
+    counter[0] += 1
+    if counter[0] > WRITE_RATE_LIMIT:
+        raise WriteRateLimitExceeded()
+
+
+@app.exception_handler(WriteRateLimitExceeded)
+async def write_rate_limit_exceeded(request: Request, exc: WriteRateLimitExceeded):
+    # Формы отправляются обычной навигацией, поэтому вместо ответа 429 пользователь
+    # возвращается на страницу, с которой пришел запрос, и видит сообщение об ошибке
+    set_flash_error(request, "Слишком много запросов, попробуйте позже")
+    referer = urlsplit(request.headers.get("referer", ""))
+    # Берется только путь: перенаправление всегда остается на этом сайте
+    url = "/" + referer.path.lstrip("/")
+    if referer.query:
+        url += "?" + referer.query
+    return RedirectResponse(url=url, status_code=303, headers={"Retry-After": str(WRITE_RATE_WINDOW)})
+
+
 # Главная страница
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     try:
-        fields = database.db.get_all_fields()
-        history = database.db.get_all_history()
-
-        total_fields = len(fields)
-        total_area = sum(field['area'] or 0 for field in fields)
-        total_records = len(history)
+        total_fields, total_area, total_records = await run_in_threadpool(
+            database.get_db().get_dashboard_counts
+        )
 
         flash_messages = get_flash_messages(request)
 
-        return templates.TemplateResponse("index.html", {
+        return render_template(INDEX_TEMPLATE, {
             "request": request,
             "total_fields": total_fields,
             "total_area": total_area,
@@ -121,7 +346,7 @@ async def read_root(request: Request):
     except Exception as e:
         print(f"Ошибка на главной странице: {e}")
         flash_messages = get_flash_messages(request)
-        return templates.TemplateResponse("index.html", {
+        return render_template(INDEX_TEMPLATE, {
             "request": request,
             "total_fields": 0,
             "total_area": 0,
@@ -133,20 +358,63 @@ async def read_root(request: Request):
 # Страница управления полями
 @app.get("/fields", response_class=HTMLResponse)
 async def read_fields(request: Request):
-    fields = database.db.get_all_fields()
+    fields = await run_in_threadpool(database.get_db().get_all_fields)
     flash_messages = get_flash_messages(request)
 
-    return templates.TemplateResponse("fields.html", {
+    return render_template(FIELDS_TEMPLATE, {
         "request": request,
         "fields": fields,
         **flash_messages
     })
 
 
-# Добавление нового поля с улучшенной обработкой полигонов
-# Добавление нового поля с улучшенной обработкой полигонов
+# strict: true/false из JSON не превращаются в 1.0/0.0, целые числа допускаются
+Latitude = Annotated[float, Field(ge=-90, le=90, strict=True)]
+Longitude = Annotated[float, Field(ge=-180, le=180, strict=True)]
+
+
+class FieldCreate(BaseModel):
+    """Данные формы нового поля. polygon_coords приходит JSON-строкой и разбирается pydantic"""
+    name: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=100)]
+    area: Optional[Annotated[float, Field(ge=0)]] = None
+    latitude: Optional[Latitude] = None
+    longitude: Optional[Longitude] = None
+    polygon_coords: Optional[Json[Annotated[List[Tuple[Latitude, Longitude]], Field(min_length=3)]]] = None
+    soil_type: str = "суглинок"
+
+    @field_validator("polygon_coords", mode="before")
+    @classmethod
+    def empty_polygon_to_none(cls, value):
+        if isinstance(value, str) and not value.strip():
+            return None
+        return value
+
+
+# Сообщения об ошибках формы поля по имени поля модели
+FIELD_CREATE_ERRORS = MappingProxyType({
+    "name": "Название поля должно содержать от 1 до 100 символов",
+    "area": "Площадь поля не может быть отрицательной",
+    "latitude": "Координаты центра поля вне допустимого диапазона",
+    "longitude": "Координаты центра поля вне допустимого диапазона"
+})
+
+
+def field_create_error(exc: ValidationError) -> str:
+    """Текст flash-сообщения для первой ошибки валидации FieldCreate"""
+    error = exc.errors()[0]
+    loc = error["loc"]
+    if loc[0] != "polygon_coords":
+        return FIELD_CREATE_ERRORS.get(loc[0], "Ошибка при создании поля")
+    if error["type"] in ("greater_than_equal", "less_than_equal"):
+        return "Координаты полигона вне допустимого диапазона"
+    if len(loc) == 1 and error["type"] in ("too_short", "list_type"):
+        return "Полигон должен содержать минимум 3 точки"
+    # Битый JSON, точка не из двух чисел, объект вместо пары координат
+    return "Неверный формат полигона"
+
+
 # Добавление нового поля
-@app.post("/fields")
+@app.post("/fields", dependencies=[Depends(limit_write_rate)])
 async def create_field(
         request: Request,
         name: str = Form(...),
@@ -156,44 +424,48 @@ async def create_field(
         polygon_coords: str = Form(""),
         soil_type: str = Form("суглинок")
 ):
+    def error_redirect(message: str):
+        set_flash_error(request, message)
+        return RedirectResponse(url="/fields", status_code=303)
+
     try:
-        # Валидация названия
-        if not name.strip():
-            set_flash_error(request, "Название поля не может быть пустым")
-            return RedirectResponse(url="/fields", status_code=303)
-
-        # Валидация полигона
-        polygon_data = None
-        if polygon_coords and polygon_coords.strip():
-            try:
-                polygon_data = json.loads(polygon_coords)
-                if not isinstance(polygon_data, list) or len(polygon_data) < 3:
-                    set_flash_error(request, "Полигон должен содержать минимум 3 точки")
-                    return RedirectResponse(url="/fields", status_code=303)
-            except (json.JSONDecodeError, ValueError) as e:
-                set_flash_error(request, f"Неверный формат полигона")
-                return RedirectResponse(url="/fields", status_code=303)
+        # Название, координаты и полигон проверяются моделью за один вызов
+        try:
+            data = FieldCreate(
+                name=name, area=area, latitude=latitude, longitude=longitude,
+                polygon_coords=polygon_coords, soil_type=soil_type
+            )
+        except ValidationError as e:
+            return error_redirect(field_create_error(e))
 
         # Создаем поле
-        field_id = database.db.create_field(
-            name, area, latitude, longitude, polygon_coords, soil_type
+        field_id = await run_in_threadpool(
+            database.get_db().create_field,
+            data.name, data.area, data.latitude, data.longitude, polygon_coords, data.soil_type,
+            polygon_data=data.polygon_coords
         )
 
+        OVERVIEW_CACHE.clear()
         if field_id:
-            set_flash_message(request, f"Поле '{name}' успешно создано!")
+            set_flash_message(request, f"Поле '{data.name}' успешно создано!")
         else:
-            set_flash_error(request, "Ошибка при создании поля в базе данных")
+            return error_redirect("Ошибка при создании поля в базе данных")
 
         return RedirectResponse(url="/fields", status_code=303)
 
     except Exception as e:
         print(f"Ошибка создания поля: {e}")
-        set_flash_error(request, "Ошибка при создании поля")
-        return RedirectResponse(url="/fields", status_code=303)
+        return error_redirect("Ошибка при создании поля")
+
+
 # Детальная страница поля
 @app.get("/fields/{field_id}", response_class=HTMLResponse)
 async def read_field(request: Request, field_id: int):
-    field = database.db.get_field(field_id)
+    # Поле и его история загружаются параллельно
+    field, history = await asyncio.gather(
+        run_in_threadpool(database.get_db().get_field, field_id),
+        run_in_threadpool(database.get_db().get_field_history, field_id)
+    )
     if not field:
         raise HTTPException(status_code=404, detail="Поле не найдено")
 
@@ -201,43 +473,31 @@ async def read_field(request: Request, field_id: int):
     polygon_data = None
     if field.get('polygon_coords'):
         try:
-            polygon_data = json.loads(field['polygon_coords'])
+            polygon_data = orjson.loads(field['polygon_coords'])
         except:
             polygon_data = None
 
-    # Получаем историю поля
-    history = database.db.get_field_history(field_id)
-
-    # Формируем данные для графика севооборота
-    rotation_history = []
-    if history:
-        for record in history:
-            rotation_history.append({
-                'year': record['year'],
-                'season': record.get('season', 'весна'),
-                'crop': record['crop']
-            })
-
     flash_messages = get_flash_messages(request)
 
-    return templates.TemplateResponse("field_detail.html", {
+    return render_template(FIELD_DETAIL_TEMPLATE, {
         "request": request,
         "field": field,
         "history": history,
         "polygon_data": polygon_data,
-        "rotation_history": rotation_history,
         **flash_messages
     })
 
 
 # Удаление поля
-@app.get("/fields/delete/{field_id}")
+@app.get("/fields/delete/{field_id}", dependencies=[Depends(limit_write_rate)])
 async def delete_field(field_id: int, request: Request):
-    field = database.db.get_field(field_id)
+    field = await run_in_threadpool(database.get_db().get_field, field_id)
     if not field:
         raise HTTPException(status_code=404, detail="Поле не найдено")
 
-    success = database.db.delete_field(field_id)
+    success = await run_in_threadpool(database.get_db().delete_field, field_id)
+    GEOJSON_CACHE.pop(field_id, None)
+    OVERVIEW_CACHE.clear()
     if success:
         set_flash_message(request, f"Поле '{field['name']}' успешно удалено!")
     else:
@@ -246,21 +506,35 @@ async def delete_field(field_id: int, request: Request):
     return RedirectResponse(url="/fields", status_code=303)
 
 
+def make_etag(content):
+    return f'"{hashlib.md5(content, usedforsecurity=False).hexdigest()}"'
+
+
+def conditional_json_response(request: Request, content, etag):
+    """JSON-ответ с ETag; если у клиента актуальная копия, возвращается пустой 304"""
+    # no-cache: браузер хранит ответ, но перепроверяет его при каждом запросе,
+    # поэтому новые и удалённые поля видны на карте сразу
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
 # API: Получить все поля для карты
 @app.get("/api/fields/overview")
-async def get_fields_overview():
-    fields = database.db.get_all_fields()
-    return JSONResponse(fields)
+async def get_fields_overview(request: Request):
+    cached = OVERVIEW_CACHE.get('overview')
+    if cached is None:
+        fields = await run_in_threadpool(database.get_db().get_all_fields)
+        content = orjson.dumps(fields)
+        cached = OVERVIEW_CACHE['overview'] = (content, make_etag(content))
 
+    content, etag = cached
+    return conditional_json_response(request, content, etag)
 
-# API: Получить поле в формате GeoJSON
-@app.get("/api/fields/{field_id}/geojson")
-async def get_field_geojson(field_id: int):
-    field = database.db.get_field(field_id)
-    if not field:
-        raise HTTPException(status_code=404, detail="Поле не найдено")
 
-    # Создаем GeoJSON объект
+def build_field_geojson(field):
+    """GeoJSON FeatureCollection с полигоном поля"""
     geojson = {
         "type": "FeatureCollection",
         "features": []
@@ -268,7 +542,7 @@ async def get_field_geojson(field_id: int):
 
     if field.get('polygon_coords'):
         try:
-            coordinates = json.loads(field['polygon_coords'])
+            coordinates = orjson.loads(field['polygon_coords'])
             feature = {
                 "type": "Feature",
                 "properties": {
@@ -287,37 +561,50 @@ async def get_field_geojson(field_id: int):
         except Exception as e:
             print(f"Ошибка создания GeoJSON: {e}")
 
-    return JSONResponse(geojson)
+    return geojson
+
+
+# API: Получить поле в формате GeoJSON
+@app.get("/api/fields/{field_id}/geojson")
+async def get_field_geojson(request: Request, field_id: int):
+    # Сериализованный GeoJSON кэшируется, повторные запросы не парсят полигон заново
+    cached = GEOJSON_CACHE.get(field_id)
+    if cached is None:
+        field = await run_in_threadpool(database.get_db().get_field, field_id)
+        if not field:
+            raise HTTPException(status_code=404, detail="Поле не найдено")
+
+        content = orjson.dumps(build_field_geojson(field))
+        cached = GEOJSON_CACHE[field_id] = (content, make_etag(content))
+
+    content, etag = cached
+    return conditional_json_response(request, content, etag)
 
 
 # API: Статистика урожайности
 @app.get("/api/yield-stats")
 async def get_yield_stats(field_id: Optional[int] = Query(None)):
     try:
-        stats = database.db.get_yield_statistics(field_id)
+        stats = await run_in_threadpool(database.get_db().get_yield_statistics, field_id)
 
-        # Форматируем данные для charts.js
-        crops = []
-        yields = []
-        counts = []
+        # Форматируем данные для charts.js, средняя урожайность уже приведена в SQL
+        crops, yields, counts = zip(*(
+            (stat['crop'], stat['avg_yield'], stat['count']) for stat in stats
+        )) if stats else ((), (), ())
 
-        for stat in stats:
-            crops.append(stat['crop'])
-            yields.append(float(stat['avg_yield']) if stat['avg_yield'] else 0)
-            counts.append(stat['count'])
-
-        return {
+        # ORJSONResponse напрямую: FastAPI не прогоняет ответ через jsonable_encoder
+        return ORJSONResponse({
             "crops": crops,
             "yields": yields,
             "counts": counts
-        }
+        })
     except Exception as e:
         print(f"Ошибка получения статистики урожайности: {e}")
-        return {
+        return ORJSONResponse({
             "crops": [],
             "yields": [],
             "counts": []
-        }
+        })
 
 
 # История посадок с выбором поля на карте
@@ -325,15 +612,18 @@ async def get_yield_stats(field_id: Optional[int] = Query(None)):
 async def read_history(request: Request, year: Optional[int] = Query(None)):
     try:
         if year:
-            history = database.db.get_history_by_year(year)
+            history_query = run_in_threadpool(database.get_db().get_history_by_year, year)
         else:
-            history = database.db.get_all_history()
+            history_query = run_in_threadpool(database.get_db().get_all_history)
 
-        years = sorted(set([h['year'] for h in history]), reverse=True) if history else []
+        history, years = await asyncio.gather(
+            history_query,
+            run_in_threadpool(database.get_db().get_distinct_years)
+        )
 
         flash_messages = get_flash_messages(request)
 
-        return templates.TemplateResponse("history.html", {
+        return render_template(HISTORY_TEMPLATE, {
             "request": request,
             "history": history,
             "selected_year": year,
@@ -343,7 +633,7 @@ async def read_history(request: Request, year: Optional[int] = Query(None)):
     except Exception as e:
         print(f"Ошибка при загрузке истории: {e}")
         flash_messages = get_flash_messages(request)
-        return templates.TemplateResponse("history.html", {
+        return render_template(HISTORY_TEMPLATE, {
             "request": request,
             "history": [],
             "selected_year": year,
@@ -355,17 +645,17 @@ async def read_history(request: Request, year: Optional[int] = Query(None)):
 # Страница добавления записи с выбором поля на карте России
 @app.get("/history/add", response_class=HTMLResponse)
 async def add_history_with_map(request: Request):
-    fields = database.db.get_all_fields()
+    fields = await run_in_threadpool(database.get_db().get_all_fields)
     flash_messages = get_flash_messages(request)
 
-    return templates.TemplateResponse("add_history_map.html", {
+    return render_template(ADD_HISTORY_MAP_TEMPLATE, {
         "request": request,
         "fields": fields,
         **flash_messages
     })
 
 
-@app.post("/history/add")
+@app.post("/history/add", dependencies=[Depends(limit_write_rate)])
 async def create_history_with_map(
     request: Request,
     field_id: int = Form(...),
@@ -376,7 +666,9 @@ async def create_history_with_map(
     notes: Optional[str] = Form(None)
 ):
     try:
-        history_id = database.db.add_crop_history(field_id, year, season, crop, yield_amount, notes)
+        history_id = await run_in_threadpool(
+            database.get_db().add_crop_history, field_id, year, season, crop, yield_amount, notes
+        )
         set_flash_message(request, "Запись истории успешно добавлена!")
         return RedirectResponse(url=f"/fields/{field_id}", status_code=303)
     except Exception as e:
@@ -386,7 +678,7 @@ async def create_history_with_map(
 
 
 # Добавление записи в историю для конкретного поля
-@app.post("/fields/{field_id}/history")
+@app.post("/fields/{field_id}/history", dependencies=[Depends(limit_write_rate)])
 async def add_field_history(
     field_id: int,
     request: Request,
@@ -397,7 +689,9 @@ async def add_field_history(
     notes: Optional[str] = Form(None)
 ):
     try:
-        history_id = database.db.add_crop_history(field_id, year, season, crop, yield_amount, notes)
+        history_id = await run_in_threadpool(
+            database.get_db().add_crop_history, field_id, year, season, crop, yield_amount, notes
+        )
         set_flash_message(request, "Запись истории успешно добавлена!")
         return RedirectResponse(url=f"/fields/{field_id}", status_code=303)
     except Exception as e:
@@ -409,20 +703,20 @@ async def add_field_history(
 # Редактирование записи истории
 @app.get("/history/edit/{history_id}", response_class=HTMLResponse)
 async def edit_history(request: Request, history_id: int):
-    entry = database.db.get_history_entry(history_id)
+    entry = await run_in_threadpool(database.get_db().get_history_entry, history_id)
     if not entry:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
     flash_messages = get_flash_messages(request)
 
-    return templates.TemplateResponse("edit_history.html", {
+    return render_template(EDIT_HISTORY_TEMPLATE, {
         "request": request,
         "entry": entry,
         **flash_messages
     })
 
 
-@app.post("/history/edit/{history_id}")
+@app.post("/history/edit/{history_id}", dependencies=[Depends(limit_write_rate)])
 async def update_history(
     history_id: int,
     request: Request,
@@ -432,7 +726,7 @@ async def update_history(
     yield_amount: Optional[float] = Form(None),
     notes: Optional[str] = Form(None)
 ):
-    entry = database.db.get_history_entry(history_id)
+    entry = await run_in_threadpool(database.get_db().get_history_entry, history_id)
     if not entry:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
@@ -442,9 +736,9 @@ async def update_history(
 
 
 # Удаление записи истории
-@app.get("/history/delete/{history_id}")
+@app.get("/history/delete/{history_id}", dependencies=[Depends(limit_write_rate)])
 async def delete_history(history_id: int, request: Request):
-    field_id = database.db.delete_crop_history(history_id)
+    field_id = await run_in_threadpool(database.get_db().delete_crop_history, history_id)
     if field_id:
         set_flash_message(request, "Запись истории успешно удалена!")
         return RedirectResponse(url=f"/fields/{field_id}", status_code=303)
@@ -457,35 +751,20 @@ async def delete_history(history_id: int, request: Request):
 @app.get("/recommendations", response_class=HTMLResponse)
 async def read_recommendations(request: Request):
     try:
-        fields = database.db.get_all_fields()
-
-        # Базовые правила для культур
-        crop_rules = [
-            {"crop": "пшеница", "family": "Злаковые"},
-            {"crop": "картофель", "family": "Пасленовые"},
-            {"crop": "подсолнечник", "family": "Астровые"},
-            {"crop": "горох", "family": "Бобовые"},
-            {"crop": "ячмень", "family": "Злаковые"},
-            {"crop": "кукуруза", "family": "Злаковые"},
-            {"crop": "овёс", "family": "Злаковые"},
-            {"crop": "соя", "family": "Бобовые"},
-            {"crop": "рожь", "family": "Злаковые"},
-            {"crop": "гречиха", "family": "Гречишные"},
-            {"crop": "лён", "family": "Льновые"}
-        ]
+        fields = await run_in_threadpool(database.get_db().get_all_fields)
 
         flash_messages = get_flash_messages(request)
 
-        return templates.TemplateResponse("recommendations.html", {
+        return render_template(RECOMMENDATIONS_TEMPLATE, {
             "request": request,
             "fields": fields,
-            "crop_rules": crop_rules,
+            "crop_rules": CROP_RULES,
             **flash_messages
         })
     except Exception as e:
         print(f"Ошибка в рекомендациях: {e}")
         flash_messages = get_flash_messages(request)
-        return templates.TemplateResponse("recommendations.html", {
+        return render_template(RECOMMENDATIONS_TEMPLATE, {
             "request": request,
             "fields": [],
             "crop_rules": [],
@@ -500,23 +779,21 @@ async def get_recommendations(
         target_crop: str = Form(...)
 ):
     try:
-        fields = database.db.get_all_fields()
-        field = database.db.get_field(field_id)
+        # Независимые запросы выполняются параллельно; заодно проверяем,
+        # была ли эта культура на поле в последние годы
+        fields, field, same_crop_recently = await asyncio.gather(
+            run_in_threadpool(database.get_db().get_all_fields),
+            run_in_threadpool(database.get_db().get_field, field_id),
+            run_in_threadpool(database.get_db().has_crop_since, field_id, target_crop, datetime.now().year - 3)
+        )
 
         if not field:
             set_flash_error(request, "Поле не найдено")
             return RedirectResponse(url="/recommendations", status_code=303)
 
-        # Получаем историю поля для анализа
-        field_history = database.db.get_field_history(field_id)
-
         # Создаем рекомендации на основе истории и выбранной культуры
         recommendations = []
 
-        # Проверяем, была ли эта культура на поле в последние годы
-        recent_years = [record for record in field_history if record['year'] >= datetime.now().year - 3]
-        same_crop_recently = any(record['crop'] == target_crop for record in recent_years)
-
         if same_crop_recently:
             recommendations.append({
                 "type": "warning",
@@ -533,14 +810,7 @@ async def get_recommendations(
         # Добавляем рекомендации по типу почвы
         soil_type = field.get('soil_type', 'не указан')
         if soil_type != 'не указан':
-            soil_recommendations = {
-                'суглинок': 'Хорошо подходит для большинства культур',
-                'чернозем': 'Отличная почва для всех культур',
-                'песчаная': 'Требует больше полива и удобрений',
-                'глинистая': 'Нуждается в улучшении дренажа',
-                'торфяная': 'Требует известкования'
-            }
-            soil_advice = soil_recommendations.get(soil_type, 'Убедитесь в соответствии культуры типу почвы')
+            soil_advice = SOIL_RECOMMENDATIONS.get(soil_type, 'Убедитесь в соответствии культуры типу почвы')
 
             recommendations.append({
                 "type": "info",
@@ -549,13 +819,7 @@ async def get_recommendations(
             })
 
         # Добавляем сезонные рекомендации
-        current_month = datetime.now().month
-        if current_month in [3, 4, 5]:  # весна
-            season_advice = "Оптимальное время для весенней посадки"
-        elif current_month in [6, 7, 8]:  # лето
-            season_advice = "Рассмотрите возможность летнего посева или подготовки к осени"
-        else:  # осень
-            season_advice = "Подходящее время для осенней посадки озимых культур"
+        season_advice = SEASON_ADVICE[datetime.now().month]
 
         recommendations.append({
             "type": "info",
@@ -566,12 +830,7 @@ async def get_recommendations(
         # Добавляем рекомендации по площади
         area = field.get('area', 0)
         if area > 0:
-            if area < 5:
-                area_advice = "Малая площадь - рассмотрите интенсивные технологии"
-            elif area < 20:
-                area_advice = "Средняя площадь - подходят стандартные технологии"
-            else:
-                area_advice = "Большая площадь - эффективны механизированные технологии"
+            area_advice = AREA_ADVICE[bisect_right(AREA_ADVICE_BOUNDS, area)]
 
             recommendations.append({
                 "type": "info",
@@ -579,27 +838,12 @@ async def get_recommendations(
                 "message": f"Площадь: {area} га. {area_advice}."
             })
 
-        # Базовые правила для культур
-        crop_rules = [
-            {"crop": "пшеница", "family": "Злаковые"},
-            {"crop": "картофель", "family": "Пасленовые"},
-            {"crop": "подсолнечник", "family": "Астровые"},
-            {"crop": "горох", "family": "Бобовые"},
-            {"crop": "ячмень", "family": "Злаковые"},
-            {"crop": "кукуруза", "family": "Злаковые"},
-            {"crop": "овёс", "family": "Злаковые"},
-            {"crop": "соя", "family": "Бобовые"},
-            {"crop": "рожь", "family": "Злаковые"},
-            {"crop": "гречиха", "family": "Гречишные"},
-            {"crop": "лён", "family": "Льновые"}
-        ]
-
         flash_messages = get_flash_messages(request)
 
-        return templates.TemplateResponse("recommendations.html", {
+        return render_template(RECOMMENDATIONS_TEMPLATE, {
             "request": request,
             "fields": fields,
-            "crop_rules": crop_rules,
+            "crop_rules": CROP_RULES,
             "recommendations": recommendations,
             "selected_field_id": field_id,
             "target_crop": target_crop,
@@ -617,7 +861,7 @@ async def get_recommendations(
 @app.get("/calculator", response_class=HTMLResponse)
 async def read_calculator(request: Request):
     flash_messages = get_flash_messages(request)
-    return templates.TemplateResponse("calculator.html", {
+    return render_template(CALCULATOR_TEMPLATE, {
         "request": request,
         **flash_messages
     })
@@ -629,22 +873,7 @@ async def calculate_economics(
     crop: str = Form(...),
     area: float = Form(...)
 ):
-    # Существующая логика калькулятора...
-    prices = {
-        "пшеница": {"cost_per_ha": 15000, "income_per_ha": 30000},
-        "картофель": {"cost_per_ha": 50000, "income_per_ha": 80000},
-        "подсолнечник": {"cost_per_ha": 25000, "income_per_ha": 45000},
-        "горох": {"cost_per_ha": 18000, "income_per_ha": 35000},
-        "ячмень": {"cost_per_ha": 14000, "income_per_ha": 28000},
-        "кукуруза": {"cost_per_ha": 30000, "income_per_ha": 60000},
-        "овёс": {"cost_per_ha": 13000, "income_per_ha": 25000},
-        "соя": {"cost_per_ha": 22000, "income_per_ha": 45000},
-        "рожь": {"cost_per_ha": 12000, "income_per_ha": 24000},
-        "гречиха": {"cost_per_ha": 16000, "income_per_ha": 32000},
-        "лён": {"cost_per_ha": 20000, "income_per_ha": 40000}
-    }
-
-    crop_data = prices.get(crop, {"cost_per_ha": 20000, "income_per_ha": 40000})
+    crop_data = CROP_PRICES.get(crop, DEFAULT_CROP_PRICE)
 
     total_cost = crop_data["cost_per_ha"] * area
     total_income = crop_data["income_per_ha"] * area
@@ -653,7 +882,7 @@ async def calculate_economics(
 
     flash_messages = get_flash_messages(request)
 
-    return templates.TemplateResponse("calculator.html", {
+    return render_template(CALCULATOR_TEMPLATE, {
         "request": request,
         "calculation": True,
         "crop": crop,
@@ -1,394 +1,814 @@
 import sqlite3
-import json
+import orjson
 import math
 from datetime import datetime
 from typing import List, Dict, Optional
 import requests
 import logging
+import threading
+import queue
+from contextlib import contextmanager
+from itertools import islice
+from collections import defaultdict
+from cachetools import TTLCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Сколько секунд результаты частых выборок переиспользуются без обращения к БД
+QUERY_CACHE_TTL = 10
+
+# Версия схемы в PRAGMA user_version; увеличивается при каждом изменении таблиц или индексов
+SCHEMA_VERSION = 4
+
+# Сколько записей истории вставляется одной транзакцией при массовой загрузке
+BULK_INSERT_CHUNK_SIZE = 10000
+
+# Сколько соединений с базой может быть открыто одновременно
+CONNECTION_POOL_SIZE = 8
+
+# Настройки, которые SQLite хранит для каждого соединения отдельно
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA foreign_keys=ON',
+    # ANALYZE читает не больше ~1000 строк каждого индекса: статистика приблизительная, но собирается за миллисекунды
+    'PRAGMA analysis_limit=1000'
+)
+
+# Порядковый номер сезона внутри года для сортировки истории
+SEASON_ORDER_COLUMN_SQL = '''season_order INTEGER GENERATED ALWAYS AS (
+    CASE season WHEN 'весна' THEN 1 WHEN 'лето' THEN 2 WHEN 'осень' THEN 3 ELSE 4 END
+) VIRTUAL'''
+
+# Таблица истории культур: записи удаляются вместе с полем
+CROP_HISTORY_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    field_id INTEGER,
+    year INTEGER,
+    season TEXT DEFAULT 'весна',
+    crop TEXT,
+    yield_amount REAL,
+    notes TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    ''' + SEASON_ORDER_COLUMN_SQL + ''',
+    FOREIGN KEY (field_id) REFERENCES fields (id) ON DELETE CASCADE
+)
+'''
+
+INSERT_CROP_HISTORY_SQL = '''
+INSERT INTO crop_history (field_id, year, season, crop, yield_amount, notes)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Одна строка погоды на поле за день: повторный анализ в тот же день заменяет ее
+INSERT_CLIMATE_DATA_SQL = '''
+INSERT OR REPLACE INTO climate_data (
+    field_id, date, temperature_avg, temperature_min, temperature_max,
+    precipitation, humidity, wind_speed, solar_radiation
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Таблицы приложения: поля с расширенными геоданными, история культур и погода по полям
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS fields (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    area REAL,
+    latitude REAL,
+    longitude REAL,
+    polygon_coords TEXT,
+    center_lat REAL,
+    center_lng REAL,
+    bounding_box TEXT,
+    soil_type TEXT,
+    climate_zone TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+''' + CROP_HISTORY_TABLE_SQL.format(table='crop_history') + ''';
+
+CREATE TABLE IF NOT EXISTS climate_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    field_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    temperature_avg REAL,
+    temperature_min REAL,
+    temperature_max REAL,
+    precipitation REAL,
+    humidity REAL,
+    wind_speed REAL,
+    solar_radiation REAL,
+    UNIQUE (field_id, date),
+    FOREIGN KEY (field_id) REFERENCES fields (id) ON DELETE CASCADE
+);
+'''
+
+# Индексы под условия выборок истории (по полю, по году, статистика урожайности) и сортировку списка полей.
+# ANALYZE здесь не запускается: на почти пустой базе он записал бы статистику, с которой
+# планировщик потом перестает выбирать индексы. Статистику периодически обновляет Database.refresh_statistics
+INDEXES_SQL = '''
+DROP INDEX IF EXISTS idx_crop_history_field_year_season;
+
+CREATE INDEX IF NOT EXISTS idx_crop_history_field_year_season_order
+ON crop_history (field_id, year DESC, season_order);
+
+CREATE INDEX IF NOT EXISTS idx_crop_history_year ON crop_history (year);
+
+CREATE INDEX IF NOT EXISTS idx_fields_created_at ON fields (created_at DESC);
+
+CREATE INDEX IF NOT EXISTS idx_crop_history_crop_yield
+ON crop_history (crop, yield_amount) WHERE yield_amount IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_crop_history_field_crop_yield
+ON crop_history (field_id, crop, yield_amount) WHERE yield_amount IS NOT NULL;
+'''
+
+
+def dict_factory(cursor, row):
+    """Строки результата сразу собираются в dict, без промежуточного sqlite3.Row"""
+    columns = [column[0] for column in cursor.description]
+    return dict(zip(columns, row))
+
+
+def fetch_dicts(cursor):
+    """Все строки результата в виде dict для выборок из многих строк.
+
+    В отличие от dict_factory, имена столбцов читаются из description один раз на запрос, а не на каждую строку
+    """
+    cursor.row_factory = None
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class _ConnectionPool:
+    """Ограниченный пул долгоживущих соединений, общий для всех потоков.
+
+    Соединения открываются по мере надобности, но не больше size. Свободные выдаются
+    в порядке LIFO, чтобы чаще работало соединение с уже прогретым кэшем страниц
+    """
+
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        # Соединения, которые были заняты во время close(): закрываются при возврате
+        self._retired = set()
+
+    @contextmanager
+    def acquire(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            # Незавершенная транзакция не должна достаться следующему потоку
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                retired = conn in self._retired
+                self._retired.discard(conn)
+            if retired:
+                self._close_connection(conn)
+            else:
+                self._idle.put(conn)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self._size:
+                conn = self._factory()
+                self._connections.append(conn)
+                return conn
+        # Все соединения заняты: ждем, пока какое-нибудь вернется в пул
+        return self._idle.get()
+
+    def run_on_idle(self, sql):
+        """Выполнение запроса на каждом свободном соединении; занятые соединения не трогаются"""
+        connections = []
+        try:
+            while True:
+                connections.append(self._idle.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            for conn in connections:
+                conn.execute(sql)
+        finally:
+            for conn in connections:
+                self._idle.put(conn)
+
+    @staticmethod
+    def _close_connection(conn):
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"Ошибка закрытия соединения с базой: {e}")
+
+    def close(self):
+        """Закрытие свободных соединений; занятые закрываются, когда их вернут в пул"""
+        with self._lock:
+            idle = []
+            try:
+                while True:
+                    idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                pass
+            self._retired.update(conn for conn in self._connections if conn not in idle)
+            self._connections.clear()
+        # Ошибка на одном соединении не мешает закрыть остальные
+        for conn in idle:
+            self._close_connection(conn)
+
 
 class Database:
     def __init__(self, db_path="crop_rotation.db"):
         self.db_path = db_path
-        self.init_db()
-        self.init_crop_rules()
-
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        # Соединения живут всё время работы приложения и переиспользуются любыми потоками
+        self._pool = _ConnectionPool(self._connect, CONNECTION_POOL_SIZE)
+        # Кэш списков полей, истории и сводных счётчиков, сбрасывается при любом изменении данных
+        self._query_cache = TTLCache(maxsize=16, ttl=QUERY_CACHE_TTL)
+        self._query_cache_lock = threading.Lock()
+        # Если схема уже актуальна, создание таблиц, миграции и начальные данные пропускаются
+        with self._pool.acquire() as conn:
+            schema_version = conn.execute('PRAGMA user_version').fetchone()['user_version']
+        if schema_version < SCHEMA_VERSION:
+            self.init_db()
+            self.init_crop_rules()
+
+    def _connect(self):
+        """Новое соединение для пула с настройками производительности"""
+        # Кэш подготовленных запросов с запасом вмещает все запросы модуля
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = dict_factory
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
 
+    def close(self):
+        """Закрытие всех открытых соединений"""
+        self._pool.close()
+
+    def refresh_statistics(self):
+        """Пересбор статистики планировщика под текущий объем данных"""
+        try:
+            with self._pool.acquire() as conn:
+                conn.execute('ANALYZE')
+            # Соединения держат статистику в памяти, ANALYZE sqlite_schema перечитывает ее из базы
+            self._pool.run_on_idle('ANALYZE sqlite_schema')
+        except Exception as e:
+            print(f"Ошибка обновления статистики базы: {e}")
+
+    def _get_cached(self, key):
+        with self._query_cache_lock:
+            return self._query_cache.get(key)
+
+    def _set_cached(self, key, value):
+        with self._query_cache_lock:
+            self._query_cache[key] = value
+
+    def _invalidate_cache(self):
+        with self._query_cache_lock:
+            self._query_cache.clear()
+
     def init_db(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        # Таблица полей с расширенными геоданными
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS fields (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            area REAL,
-            latitude REAL,
-            longitude REAL,
-            polygon_coords TEXT,
-            center_lat REAL,
-            center_lng REAL,
-            bounding_box TEXT,
-            soil_type TEXT,
-            climate_zone TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
+            # WAL сохраняется в файле базы: запись не блокирует чтение, а коммит не требует fsync журнала
+            conn.execute('PRAGMA journal_mode=WAL')
 
-        # Таблица истории культур
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS crop_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            field_id INTEGER,
-            year INTEGER,
-            season TEXT DEFAULT 'весна',
-            crop TEXT,
-            yield_amount REAL,
-            notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (field_id) REFERENCES fields (id)
-        )
-        ''')
+            # Таблицы создаются одним скриптом
+            conn.executescript(SCHEMA_SQL)
 
-        # Добавляем столбец season если его нет
-        try:
-            cursor.execute("SELECT season FROM crop_history LIMIT 1")
-        except sqlite3.OperationalError:
-            cursor.execute('ALTER TABLE crop_history ADD COLUMN season TEXT DEFAULT "весна"')
+            # Добавляем столбцы season и season_order если их нет: схема проверяется по PRAGMA, без перехвата ошибки.
+            # table_xinfo, в отличие от table_info, показывает и вычисляемые столбцы
+            columns = {row['name'] for row in cursor.execute('PRAGMA table_xinfo(crop_history)')}
+            if 'season' not in columns:
+                cursor.execute("ALTER TABLE crop_history ADD COLUMN season TEXT DEFAULT 'весна'")
+            if 'season_order' not in columns:
+                cursor.execute('ALTER TABLE crop_history ADD COLUMN ' + SEASON_ORDER_COLUMN_SQL)
+
+            # Базы, созданные до каскадного удаления, переводятся на него один раз
+            foreign_keys = cursor.execute('PRAGMA foreign_key_list(crop_history)').fetchall()
+            if any(fk['on_delete'] != 'CASCADE' for fk in foreign_keys):
+                self._rebuild_crop_history(cursor)
+
+            # Индексы ссылаются на season, поэтому создаются после миграций
+            conn.executescript(INDEXES_SQL)
 
-        conn.commit()
-        conn.close()
-        print("База данных инициализирована")
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+            print("База данных инициализирована")
+
+    def _rebuild_crop_history(self, cursor):
+        """Пересоздание crop_history с ON DELETE CASCADE, записи удалённых полей не переносятся"""
+        cursor.execute('BEGIN')
+        # Такие записи до сих пор попадали в статистику урожайности и проверку has_crop_since,
+        # поэтому их удаление фиксируется в логе
+        orphans = cursor.execute('''
+        SELECT COUNT(*) AS records, COUNT(DISTINCT field_id) AS fields
+        FROM crop_history
+        WHERE field_id IS NULL OR field_id NOT IN (SELECT id FROM fields)
+        ''').fetchone()
+        if orphans['records']:
+            logger.warning(
+                f"Удаляются записи истории без поля: {orphans['records']} "
+                f"(несуществующих полей: {orphans['fields']})"
+            )
+        cursor.execute(CROP_HISTORY_TABLE_SQL.format(table='crop_history_new'))
+        cursor.execute('''
+        INSERT INTO crop_history_new (id, field_id, year, season, crop, yield_amount, notes, created_at)
+        SELECT id, field_id, year, season, crop, yield_amount, notes, created_at
+        FROM crop_history
+        WHERE field_id IN (SELECT id FROM fields)
+        ''')
+        cursor.execute('DROP TABLE crop_history')
+        cursor.execute('ALTER TABLE crop_history_new RENAME TO crop_history')
+        print("Таблица истории культур переведена на каскадное удаление")
 
     def init_crop_rules(self):
         """Инициализация базовых правил для культур"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        # Базовые правила для основных культур
-        base_crops = [
-            ("пшеница", "Злаковые"),
-            ("картофель", "Пасленовые"),
-            ("подсолнечник", "Астровые"),
-            ("горох", "Бобовые"),
-            ("ячмень", "Злаковые"),
-            ("кукуруза", "Злаковые"),
-            ("овёс", "Злаковые"),
-            ("соя", "Бобовые"),
-            ("рожь", "Злаковые"),
-            ("гречиха", "Гречишные"),
-            ("лён", "Льновые")
-        ]
-
-        for crop, family in base_crops:
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            # Базовые правила для основных культур
+            base_crops = [
+                ("пшеница", "Злаковые"),
+                ("картофель", "Пасленовые"),
+                ("подсолнечник", "Астровые"),
+                ("горох", "Бобовые"),
+                ("ячмень", "Злаковые"),
+                ("кукуруза", "Злаковые"),
+                ("овёс", "Злаковые"),
+                ("соя", "Бобовые"),
+                ("рожь", "Злаковые"),
+                ("гречиха", "Гречишные"),
+                ("лён", "Льновые")
+            ]
+
+            # Все правила вставляются одним подготовленным запросом
             try:
-                cursor.execute('''
+                cursor.executemany('''
                 INSERT OR IGNORE INTO crop_rules (crop, family)
                 VALUES (?, ?)
-                ''', (crop, family))
+                ''', base_crops)
             except Exception as e:
-                print(f"Ошибка при добавлении культуры {crop}: {e}")
+                print(f"Ошибка при добавлении правил культур: {e}")
 
-        conn.commit()
-        conn.close()
-        print("Правила культур инициализированы")
+            conn.commit()
+            print("Правила культур инициализированы")
 
-    def create_field(self, name, area, latitude, longitude, polygon_coords, soil_type):
-        """Создание нового поля с поддержкой полигонов"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def create_field(self, name, area, latitude, longitude, polygon_coords, soil_type, polygon_data=None):
+        """Создание нового поля с поддержкой полигонов.
 
-        try:
-            print(f"Создание поля в БД: name={name}, area={area}, lat={latitude}, lng={longitude}, soil_type={soil_type}")
-
-            # Вычисляем bounding box если есть полигон
-            bounding_box = None
-            center_lat = latitude
-            center_lng = longitude
-
-            if polygon_coords and polygon_coords.strip():
-                try:
-                    coords = json.loads(polygon_coords)
-                    lats = [point[0] for point in coords]
-                    lngs = [point[1] for point in coords]
-
-                    # Вычисляем bounding box
-                    bbox = {
-                        'min_lat': min(lats),
-                        'max_lat': max(lats),
-                        'min_lng': min(lngs),
-                        'max_lng': max(lngs)
-                    }
-                    bounding_box = json.dumps(bbox)
-
-                    # Если координаты центра не указаны, вычисляем их из полигона
-                    if not (latitude and longitude):
-                        center_lat = sum(lats) / len(lats)
-                        center_lng = sum(lngs) / len(lngs)
-
-                except Exception as e:
-                    print(f"Ошибка обработки полигона: {e}")
-                    bounding_box = None
-
-            cursor.execute('''
-            INSERT INTO fields (name, area, latitude, longitude, polygon_coords,
-            center_lat, center_lng, bounding_box, soil_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (name, area, latitude, longitude, polygon_coords,
-                  center_lat, center_lng, bounding_box, soil_type))
-
-            field_id = cursor.lastrowid
-            conn.commit()
-            print(f"Поле успешно создано с ID: {field_id}")
-            return field_id
+        polygon_data - уже разобранные координаты polygon_coords, если вызывающий код их распарсил
+        """
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        except Exception as e:
-            print(f"Ошибка при создании поля в БД: {e}")
-            conn.rollback()
-            return None
-        finally:
-            conn.close()
+            try:
+                print(f"Создание поля в БД: name={name}, area={area}, lat={latitude}, lng={longitude}, soil_type={soil_type}")
+
+                # Вычисляем bounding box если есть полигон
+                bounding_box = None
+                center_lat = latitude
+                center_lng = longitude
+
+                if polygon_coords and polygon_coords.strip():
+                    try:
+                        coords = polygon_data if polygon_data is not None else orjson.loads(polygon_coords)
+                        # Широты и долготы разделяются за один проход по точкам
+                        lats, lngs = zip(*coords)
+
+                        # Вычисляем bounding box
+                        bbox = {
+                            'min_lat': min(lats),
+                            'max_lat': max(lats),
+                            'min_lng': min(lngs),
+                            'max_lng': max(lngs)
+                        }
+                        bounding_box = orjson.dumps(bbox).decode()
+
+                        # Если координаты центра не указаны, вычисляем их из полигона
+                        if not (latitude and longitude):
+                            center_lat = sum(lats) / len(lats)
+                            center_lng = sum(lngs) / len(lngs)
+
+                    except Exception as e:
+                        print(f"Ошибка обработки полигона: {e}")
+                        bounding_box = None
+
+                cursor.execute('''
+                INSERT INTO fields (name, area, latitude, longitude, polygon_coords,
+                center_lat, center_lng, bounding_box, soil_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (name, area, latitude, longitude, polygon_coords,
+                      center_lat, center_lng, bounding_box, soil_type))
+
+                field_id = cursor.lastrowid
+                conn.commit()
+                self._invalidate_cache()
+                print(f"Поле успешно создано с ID: {field_id}")
+                return field_id
+
+            except Exception as e:
+                print(f"Ошибка при создании поля в БД: {e}")
+                conn.rollback()
+                return None
 
     def get_all_fields(self):
         """Получение всех полей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        try:
-            cursor.execute('''
-            SELECT id, name, area, latitude, longitude, polygon_coords,
-            center_lat, center_lng, soil_type, created_at
-            FROM fields
-            ORDER BY created_at DESC
-            ''')
-
-            fields = [dict(row) for row in cursor.fetchall()]
+        fields = self._get_cached('fields')
+        if fields is not None:
             return fields
-        except Exception as e:
-            print(f"Ошибка при получении полей: {e}")
-            return []
-        finally:
-            conn.close()
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute('''
+                SELECT id, name, area, latitude, longitude, polygon_coords,
+                center_lat, center_lng, soil_type, created_at
+                FROM fields
+                ORDER BY created_at DESC
+                ''')
+
+                fields = fetch_dicts(cursor)
+                self._set_cached('fields', fields)
+                return fields
+            except Exception as e:
+                print(f"Ошибка при получении полей: {e}")
+                return []
 
     def get_field(self, field_id):
         """Получение поля по ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-            SELECT id, name, area, latitude, longitude, polygon_coords,
-            center_lat, center_lng, soil_type, created_at
-            FROM fields
-            WHERE id = ?
-            ''', (field_id,))
-
-            row = cursor.fetchone()
-            return dict(row) if row else None
-        except Exception as e:
-            print(f"Ошибка при получении поля {field_id}: {e}")
-            return None
-        finally:
-            conn.close()
+            try:
+                cursor.execute('''
+                SELECT id, name, area, latitude, longitude, polygon_coords,
+                center_lat, center_lng, soil_type, created_at
+                FROM fields
+                WHERE id = ?
+                ''', (field_id,))
+
+                return cursor.fetchone()
+            except Exception as e:
+                print(f"Ошибка при получении поля {field_id}: {e}")
+                return None
+
+    def get_fields_by_ids(self, field_ids):
+        """Получение нескольких полей одним запросом: словарь {id: поле}, отсутствующие id пропускаются"""
+        field_ids = list(field_ids)
+        if not field_ids:
+            return {}
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                placeholders = ', '.join('?' * len(field_ids))
+                cursor.execute(f'''
+                SELECT id, name, area, latitude, longitude, polygon_coords,
+                center_lat, center_lng, soil_type, created_at
+                FROM fields
+                WHERE id IN ({placeholders})
+                ''', field_ids)
+
+                return {field['id']: field for field in fetch_dicts(cursor)}
+            except Exception as e:
+                print(f"Ошибка при получении полей {field_ids}: {e}")
+                return {}
 
     def delete_field(self, field_id):
         """Удаление поля"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            # Сначала удаляем связанные записи истории
-            cursor.execute('DELETE FROM crop_history WHERE field_id = ?', (field_id,))
-            # Затем удаляем поле
-            cursor.execute('DELETE FROM fields WHERE id = ?', (field_id,))
-            conn.commit()
-            success = True
-            print(f"Поле {field_id} успешно удалено")
-        except Exception as e:
-            print(f"Ошибка удаления поля {field_id}: {e}")
-            conn.rollback()
-            success = False
-        finally:
-            conn.close()
+            try:
+                # Записи истории поля удаляются каскадно по внешнему ключу
+                cursor.execute('DELETE FROM fields WHERE id = ?', (field_id,))
+                conn.commit()
+                self._invalidate_cache()
+                success = True
+                print(f"Поле {field_id} успешно удалено")
+            except Exception as e:
+                print(f"Ошибка удаления поля {field_id}: {e}")
+                conn.rollback()
+                success = False
 
-        return success
+            return success
 
     def get_field_history(self, field_id):
         """Получение истории культур для поля"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-            SELECT ch.*, f.name as field_name, f.area as field_area
-            FROM crop_history ch
-            JOIN fields f ON ch.field_id = f.id
-            WHERE ch.field_id = ?
-            ORDER BY ch.year DESC,
-            CASE
-                WHEN ch.season = 'весна' THEN 1
-                WHEN ch.season = 'лето' THEN 2
-                WHEN ch.season = 'осень' THEN 3
-                ELSE 4
-            END
-            ''', (field_id,))
-
-            history = [dict(row) for row in cursor.fetchall()]
-            return history
-        except Exception as e:
-            print(f"Ошибка при получении истории поля {field_id}: {e}")
-            return []
-        finally:
-            conn.close()
+            try:
+                cursor.execute('''
+                SELECT ch.*, f.name as field_name, f.area as field_area
+                FROM crop_history ch
+                JOIN fields f ON ch.field_id = f.id
+                WHERE ch.field_id = ?
+                ORDER BY ch.year DESC, ch.season_order
+                ''', (field_id,))
+
+                history = fetch_dicts(cursor)
+                return history
+            except Exception as e:
+                print(f"Ошибка при получении истории поля {field_id}: {e}")
+                return []
+
+    def has_crop_since(self, field_id, crop, since_year):
+        """Выращивалась ли культура на поле начиная с указанного года"""
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute('''
+                SELECT EXISTS(
+                    SELECT 1 FROM crop_history
+                    WHERE field_id = ? AND crop = ? AND year >= ?
+                ) as found
+                ''', (field_id, crop, since_year))
+
+                return bool(cursor.fetchone()['found'])
+            except Exception as e:
+                print(f"Ошибка при проверке истории поля {field_id}: {e}")
+                return False
 
     def add_crop_history(self, field_id, year, season, crop, yield_amount=None, notes=None):
         """Добавление записи в историю культур"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-            INSERT INTO crop_history (field_id, year, season, crop, yield_amount, notes)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (field_id, year, season, crop, yield_amount, notes))
+            try:
+                cursor.execute(INSERT_CROP_HISTORY_SQL, (field_id, year, season, crop, yield_amount, notes))
 
-            history_id = cursor.lastrowid
-            conn.commit()
-            print(f"Запись истории добавлена с ID: {history_id}")
-            return history_id
-        except Exception as e:
-            print(f"Ошибка при добавлении записи истории: {e}")
-            conn.rollback()
-            return None
-        finally:
-            conn.close()
+                history_id = cursor.lastrowid
+                conn.commit()
+                self._invalidate_cache()
+                print(f"Запись истории добавлена с ID: {history_id}")
+                return history_id
+            except Exception as e:
+                print(f"Ошибка при добавлении записи истории: {e}")
+                conn.rollback()
+                return None
+
+    def add_crop_history_bulk(self, rows):
+        """Массовое добавление записей в историю культур.
+
+        rows - кортежи (field_id, year, season, crop, yield_amount, notes). Каждые
+        BULK_INSERT_CHUNK_SIZE записей вставляются одним executemany в одной транзакции.
+        Возвращает число добавленных записей
+        """
+        rows = iter(rows)
+        inserted = 0
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                while True:
+                    chunk = list(islice(rows, BULK_INSERT_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    cursor.executemany(INSERT_CROP_HISTORY_SQL, chunk)
+                    conn.commit()
+                    inserted += len(chunk)
+            except Exception as e:
+                print(f"Ошибка при массовом добавлении истории: {e}")
+                conn.rollback()
+
+            if inserted:
+                self._invalidate_cache()
+            print(f"Добавлено записей истории: {inserted}")
+            return inserted
+
+    def save_climate_data(self, rows):
+        """Сохранение погоды по полям одним executemany в одной транзакции.
+
+        rows - кортежи (field_id, date, temperature_avg, temperature_min, temperature_max,
+        precipitation, humidity, wind_speed, solar_radiation). Возвращает число сохраненных записей
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.executemany(INSERT_CLIMATE_DATA_SQL, rows)
+                conn.commit()
+                return len(rows)
+            except Exception as e:
+                print(f"Ошибка при сохранении климатических данных: {e}")
+                conn.rollback()
+                return 0
 
     def get_all_history(self):
         """Получение всей истории"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        try:
-            cursor.execute('''
-            SELECT ch.*, f.name as field_name, f.area as field_area
-            FROM crop_history ch
-            JOIN fields f ON ch.field_id = f.id
-            ORDER BY ch.year DESC, ch.created_at DESC
-            ''')
-
-            history = [dict(row) for row in cursor.fetchall()]
+        history = self._get_cached('history')
+        if history is not None:
             return history
-        except Exception as e:
-            print(f"Ошибка при получении всей истории: {e}")
-            return []
-        finally:
-            conn.close()
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute('''
+                SELECT ch.*, f.name as field_name, f.area as field_area
+                FROM crop_history ch
+                JOIN fields f ON ch.field_id = f.id
+                ORDER BY ch.year DESC, ch.created_at DESC
+                ''')
+
+                history = fetch_dicts(cursor)
+                self._set_cached('history', history)
+                return history
+            except Exception as e:
+                print(f"Ошибка при получении всей истории: {e}")
+                return []
+
+    def get_dashboard_counts(self):
+        """Количество полей, их общая площадь и количество записей истории"""
+        counts = self._get_cached('dashboard')
+        if counts is not None:
+            return counts
+
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM fields) as total_fields,
+                    (SELECT COALESCE(SUM(area), 0) FROM fields) as total_area,
+                    (SELECT COUNT(*) FROM crop_history ch JOIN fields f ON ch.field_id = f.id) as total_records
+                ''')
+
+                counts = tuple(cursor.fetchone().values())
+                self._set_cached('dashboard', counts)
+                return counts
+            except Exception as e:
+                print(f"Ошибка при получении сводной статистики: {e}")
+                return 0, 0, 0
 
     def get_history_by_year(self, year):
         """Получение истории по году"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-            SELECT ch.*, f.name as field_name, f.area as field_area
-            FROM crop_history ch
-            JOIN fields f ON ch.field_id = f.id
-            WHERE ch.year = ?
-            ORDER BY ch.created_at DESC
-            ''', (year,))
-
-            history = [dict(row) for row in cursor.fetchall()]
-            return history
-        except Exception as e:
-            print(f"Ошибка при получении истории за год {year}: {e}")
-            return []
-        finally:
-            conn.close()
+            try:
+                cursor.execute('''
+                SELECT ch.*, f.name as field_name, f.area as field_area
+                FROM crop_history ch
+                JOIN fields f ON ch.field_id = f.id
+                WHERE ch.year = ?
+                ORDER BY ch.created_at DESC
+                ''', (year,))
+
+                history = fetch_dicts(cursor)
+                return history
+            except Exception as e:
+                print(f"Ошибка при получении истории за год {year}: {e}")
+                return []
+
+    def get_distinct_years(self):
+        """Годы, за которые есть записи истории, от новых к старым"""
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute('''
+                SELECT DISTINCT ch.year
+                FROM crop_history ch
+                JOIN fields f ON ch.field_id = f.id
+                ORDER BY ch.year DESC
+                ''')
+
+                return [row['year'] for row in cursor.fetchall()]
+            except Exception as e:
+                print(f"Ошибка при получении списка лет: {e}")
+                return []
 
     def get_history_entry(self, history_id):
         """Получение конкретной записи истории"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-            SELECT ch.*, f.name as field_name
-            FROM crop_history ch
-            JOIN fields f ON ch.field_id = f.id
-            WHERE ch.id = ?
-            ''', (history_id,))
-
-            row = cursor.fetchone()
-            return dict(row) if row else None
-        except Exception as e:
-            print(f"Ошибка при получении записи истории {history_id}: {e}")
-            return None
-        finally:
-            conn.close()
+            try:
+                cursor.execute('''
+                SELECT ch.*, f.name as field_name
+                FROM crop_history ch
+                JOIN fields f ON ch.field_id = f.id
+                WHERE ch.id = ?
+                ''', (history_id,))
+
+                return cursor.fetchone()
+            except Exception as e:
+                print(f"Ошибка при получении записи истории {history_id}: {e}")
+                return None
 
     def delete_crop_history(self, history_id):
         """Удаление записи истории"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            # Получаем field_id перед удалением
-            cursor.execute('SELECT field_id FROM crop_history WHERE id = ?', (history_id,))
-            row = cursor.fetchone()
-            field_id = row['field_id'] if row else None
-
-            cursor.execute('DELETE FROM crop_history WHERE id = ?', (history_id,))
-            conn.commit()
-            print(f"Запись истории {history_id} удалена")
-            return field_id
-        except Exception as e:
-            print(f"Ошибка удаления записи истории {history_id}: {e}")
-            conn.rollback()
-            return None
-        finally:
-            conn.close()
+            try:
+                # Получаем field_id перед удалением
+                cursor.execute('SELECT field_id FROM crop_history WHERE id = ?', (history_id,))
+                row = cursor.fetchone()
+                field_id = row['field_id'] if row else None
+
+                cursor.execute('DELETE FROM crop_history WHERE id = ?', (history_id,))
+                conn.commit()
+                self._invalidate_cache()
+                print(f"Запись истории {history_id} удалена")
+                return field_id
+            except Exception as e:
+                print(f"Ошибка удаления записи истории {history_id}: {e}")
+                conn.rollback()
+                return None
 
     def get_yield_statistics(self, field_id=None):
         """Получение статистики урожайности"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
 
-        try:
-            if field_id:
-                cursor.execute('''
-                SELECT crop, AVG(yield_amount) as avg_yield, COUNT(*) as count
-                FROM crop_history
-                WHERE field_id = ? AND yield_amount IS NOT NULL
-                GROUP BY crop
-                ORDER BY avg_yield DESC
-                ''', (field_id,))
-            else:
+            try:
+                if field_id:
+                    cursor.execute('''
+                    SELECT crop, COALESCE(AVG(yield_amount), 0.0) as avg_yield, COUNT(*) as count
+                    FROM crop_history
+                    WHERE field_id = ? AND yield_amount IS NOT NULL
+                    GROUP BY crop
+                    ORDER BY avg_yield DESC
+                    ''', (field_id,))
+                else:
+                    cursor.execute('''
+                    SELECT crop, COALESCE(AVG(yield_amount), 0.0) as avg_yield, COUNT(*) as count
+                    FROM crop_history
+                    WHERE yield_amount IS NOT NULL
+                    GROUP BY crop
+                    ORDER BY avg_yield DESC
+                    ''')
+
+                stats = fetch_dicts(cursor)
+                return stats
+            except Exception as e:
+                print(f"Ошибка при получении статистики урожайности: {e}")
+                return []
+
+    def get_yield_statistics_all_fields(self):
+        """Статистика урожайности сразу по всем полям одним запросом.
+
+        Возвращает словарь {id поля: список культур}, записи в том же формате и порядке,
+        что и get_yield_statistics(field_id)
+        """
+        with self._pool.acquire() as conn:
+            cursor = conn.cursor()
+
+            try:
                 cursor.execute('''
-                SELECT crop, AVG(yield_amount) as avg_yield, COUNT(*) as count
+                SELECT field_id, crop, COALESCE(AVG(yield_amount), 0.0) as avg_yield, COUNT(*) as count
                 FROM crop_history
                 WHERE yield_amount IS NOT NULL
-                GROUP BY crop
-                ORDER BY avg_yield DESC
+                GROUP BY field_id, crop
+                ORDER BY field_id, avg_yield DESC
                 ''')
 
-            stats = [dict(row) for row in cursor.fetchall()]
-            return stats
-        except Exception as e:
-            print(f"Ошибка при получении статистики урожайности: {e}")
-            return []
-        finally:
-            conn.close()
+                stats = defaultdict(list)
+                for row in fetch_dicts(cursor):
+                    stats[row.pop('field_id')].append(row)
+                return dict(stats)
+            except Exception as e:
+                print(f"Ошибка при получении статистики урожайности по полям: {e}")
+                return {}
+
+
+# Глобальный экземпляр базы данных создается при первом обращении, а не при импорте модуля
+_db_instance = None
+_db_lock = threading.Lock()
 
 
-# Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+def get_db():
+    """Общий экземпляр Database"""
+    global _db_instance
+    if _db_instance is None:
+        with _db_lock:
+            if _db_instance is None:
+                _db_instance = Database()
+    return _db_instance
\ No newline at end of file
@@ -21,7 +21,7 @@ class MarketDataService:
 
         for crop in crops:
             # Пытаемся получить цену из базы данных
-            db_price = database.db.get_current_market_price(crop, region)
+            db_price = database.get_db().get_current_market_price(crop, region)
             if db_price:
                 prices[crop] = db_price
             else:
@@ -52,18 +52,20 @@ class MarketDataService:
 
         today = datetime.now().strftime('%Y-%m-%d')
         for crop, price in mock_prices.items():
-            database.db.update_market_price(crop, price, today, region, "Минсельхоз РФ")
+            database.get_db().update_market_price(crop, price, today, region, "Минсельхоз РФ")
 
         logger.info(f"Обновлены рыночные цены для {len(mock_prices)} культур")
 
     def get_price_trend(self, crop: str, days: int = 30, region: str = "Центральный федеральный округ") -> List[Dict]:
         """Получить тренд цен за период"""
         # Мок-реализация тренда цен
-        base_price = database.db.get_current_market_price(crop, region) or self._get_mock_price(crop)
+        base_price = database.get_db().get_current_market_price(crop, region) or self._get_mock_price(crop)
         trends = []
+        # Текущая дата берется один раз, а не на каждой итерации
+        now = datetime.now()
 
         for i in range(days, 0, -1):
-            date = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
+            date = (now - timedelta(days=i)).strftime('%Y-%m-%d')
             # Имитация колебаний цен
             fluctuation = (i % 7 - 3) * 0.01  # Небольшие колебания
             price = base_price * (1 + fluctuation)
@@ -79,7 +81,7 @@ class MarketDataService:
     def calculate_profitability(self, crop: str, area: float, expected_yield: float,
                                 region: str = "Центральный федеральный округ") -> Dict:
         """Расчет рентабельности выращивания культуры"""
-        crop_rule = database.db.get_crop_rule(crop)
+        crop_rule = database.get_db().get_crop_rule(crop)
         if not crop_rule:
             return {}
 
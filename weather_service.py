@@ -1,17 +1,45 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import threading
+from cachetools import TTLCache
 import database
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Сколько полей анализируется параллельно: запросы к погодному API в основном ждут сеть
+CLIMATE_ANALYSIS_WORKERS = 8
+
+# Сколько секунд ответ погодного API переиспользуется для тех же координат
+WEATHER_CACHE_TTL = 600
+
 
 class WeatherService:
     def __init__(self, openweather_api_key: str = None):
         self.openweather_api_key = openweather_api_key
         self.base_url = "http://api.openweathermap.org/data/2.5"
+        # Одна сессия на сервис: соединения с API остаются открытыми между запросами,
+        # по одному на каждый параллельный поток анализа
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CLIMATE_ANALYSIS_WORKERS)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # Ответы API по координатам, округленным до 0.01° (около 1 км): соседние поля делят одну запись
+        self._cache = TTLCache(maxsize=1024, ttl=WEATHER_CACHE_TTL)
+        self._cache_lock = threading.Lock()
+
+    def _get_cached(self, key):
+        with self._cache_lock:
+            return self._cache.get(key)
+
+    def _set_cached(self, key, value):
+        with self._cache_lock:
+            self._cache[key] = value
 
     def get_current_weather(self, lat: float, lon: float) -> Optional[Dict]:
         """Получить текущую погоду по координатам"""
@@ -19,6 +47,11 @@ class WeatherService:
             logger.warning("OpenWeather API ключ не установлен")
             return self._get_mock_weather_data()
 
+        cache_key = ('weather', round(lat, 2), round(lon, 2))
+        weather = self._get_cached(cache_key)
+        if weather is not None:
+            return weather
+
         try:
             url = f"{self.base_url}/weather"
             params = {
@@ -29,11 +62,11 @@ class WeatherService:
                 'lang': 'ru'
             }
 
-            response = requests.get(url, params=params, timeout=10)
+            response = self._session.get(url, params=params, timeout=10)
             response.raise_for_status()
 
             data = response.json()
-            return {
+            weather = {
                 'temperature': data['main']['temp'],
                 'temperature_min': data['main']['temp_min'],
                 'temperature_max': data['main']['temp_max'],
@@ -43,6 +76,8 @@ class WeatherService:
                 'weather_description': data['weather'][0]['description'],
                 'precipitation': data.get('rain', {}).get('1h', 0) + data.get('snow', {}).get('1h', 0)
             }
+            self._set_cached(cache_key, weather)
+            return weather
         except Exception as e:
             logger.error(f"Ошибка получения погоды: {e}")
             return self._get_mock_weather_data()
@@ -52,6 +87,11 @@ class WeatherService:
         if not self.openweather_api_key:
             return self._get_mock_forecast(days)
 
+        cache_key = ('forecast', round(lat, 2), round(lon, 2), days)
+        forecasts = self._get_cached(cache_key)
+        if forecasts is not None:
+            return forecasts
+
         try:
             url = f"{self.base_url}/forecast"
             params = {
@@ -62,7 +102,7 @@ class WeatherService:
                 'lang': 'ru'
             }
 
-            response = requests.get(url, params=params, timeout=10)
+            response = self._session.get(url, params=params, timeout=10)
             response.raise_for_status()
 
             data = response.json()
@@ -81,6 +121,7 @@ class WeatherService:
                 }
                 forecasts.append(forecast)
 
+            self._set_cached(cache_key, forecasts)
             return forecasts
         except Exception as e:
             logger.error(f"Ошибка получения прогноза: {e}")
@@ -158,6 +199,29 @@ class ClimateAnalyzer:
         if not field:
             return {}
 
+        result = self._analyze_field(field)
+        self._save_climate_data({field_id: result})
+        return result
+
+    def analyze_fields_climate(self, field_ids: List[int]) -> Dict[int, Dict]:
+        """Анализ климатических условий для нескольких полей.
+
+        Поля читаются из базы одним запросом, а запросы погоды для разных полей
+        выполняются параллельно. Возвращает словарь {id поля: результат анализа}
+        """
+        fields = self.db.get_fields_by_ids(field_ids)
+        if not fields:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=CLIMATE_ANALYSIS_WORKERS) as executor:
+            results = dict(zip(fields.keys(), executor.map(self._analyze_field, fields.values())))
+
+        # Погода всех полей сохраняется одной транзакцией
+        self._save_climate_data(results)
+        return results
+
+    def _analyze_field(self, field: Dict) -> Dict:
+        """Анализ климатических условий для уже загруженного поля"""
         # Получаем текущую погоду
         current_weather = self.weather_service.get_current_weather(
             field['latitude'] or 55.7558,
@@ -173,20 +237,6 @@ class ClimateAnalyzer:
         # Анализируем климатическую зону
         climate_zone = self._determine_climate_zone(field, current_weather)
 
-        # Сохраняем климатические данные
-        if current_weather:
-            self.db.save_climate_data(
-                field_id,
-                datetime.now().strftime('%Y-%m-%d'),
-                current_weather['temperature'],
-                current_weather['temperature_min'],
-                current_weather['temperature_max'],
-                current_weather['precipitation'],
-                current_weather['humidity'],
-                current_weather['wind_speed'],
-                150  # Мок-данные солнечной радиации
-            )
-
         return {
             'current_weather': current_weather,
             'climate_zone': climate_zone,
@@ -194,6 +244,26 @@ class ClimateAnalyzer:
             'growing_season_info': self._get_growing_season_info(field)
         }
 
+    def _save_climate_data(self, results: Dict[int, Dict]):
+        """Сохранение текущей погоды из результатов анализа {id поля: результат}"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        rows = []
+        for field_id, result in results.items():
+            weather = result['current_weather']
+            if weather:
+                rows.append((
+                    field_id,
+                    today,
+                    weather['temperature'],
+                    weather['temperature_min'],
+                    weather['temperature_max'],
+                    weather['precipitation'],
+                    weather['humidity'],
+                    weather['wind_speed'],
+                    150  # Мок-данные солнечной радиации
+                ))
+        self.db.save_climate_data(rows)
+
     def _determine_climate_zone(self, field: Dict, weather: Dict) -> str:
         """Определение климатической зоны на основе данных"""
         if not weather:
@@ -212,10 +282,11 @@ class ClimateAnalyzer:
         if not forecast:
             return {}
 
-        avg_temp = sum([f['temperature'] for f in forecast]) / len(forecast)
-        total_precip = sum([f['precipitation'] for f in forecast])
-        max_temp = max([f['temperature_max'] for f in forecast])
-        min_temp = min([f['temperature_min'] for f in forecast])
+        # map с itemgetter выполняется в C и не строит промежуточных списков
+        avg_temp = sum(map(itemgetter('temperature'), forecast)) / len(forecast)
+        total_precip = sum(map(itemgetter('precipitation'), forecast))
+        max_temp = max(map(itemgetter('temperature_max'), forecast))
+        min_temp = min(map(itemgetter('temperature_min'), forecast))
 
         return {
             'avg_temperature': round(avg_temp, 1),